@@ -30,6 +30,7 @@ def main(args=None):
     runScriptSource(arguments.drawbot_script.read(), arguments.drawbot_script.name, namespace)
     for path in arguments.output_file:
         db.saveImage(path)
+    db.waitForSaves()
 
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 import logging
 import os
@@ -81,7 +82,7 @@ class RecordingDocument(Document):
         method = getattr(self, methodName, None)
         if method is None:
             raise ValueError(f"unsupported file type: {suffix}")
-        method(path, **kwargs)
+        return method(path, **kwargs)
 
     def _saveImage_pdf(self, path, **kwargs):
         stream = skia.FILEWStream(os.fspath(path))
@@ -111,7 +112,7 @@ class RecordingDocument(Document):
 
     _saveImage_jpg = _saveImage_jpeg
 
-    def _saveImage_mp4(self, path, codec="libx264", **kwargs):
+    def _saveImage_mp4(self, path, codec="libx264", background=False, **kwargs):
         from .ffmpeg import generateMP4
         if not self._pictures:
             # Empty mp4?
@@ -119,18 +120,38 @@ class RecordingDocument(Document):
         frameRate = max(1, round(1 / self._frameDurations[-1]))
         if len(set(self._frameDurations)) != 1:
             logging.warning("ignoring varying frame durations for mp4 export")
-        with tempfile.TemporaryDirectory(prefix="drawbot-skia-") as tempDir:
-            tempDir = pathlib.Path(tempDir)
-            imagePath = tempDir / "frame.png"
-            _savePixelImages(
-                self._pictures,
-                imagePath,
-                skia.kPNG,
-                whiteBackground=True,
-                singlePage=False,
-            )
-            imagesTemplate = tempDir / "frame_%d.png"
-            generateMP4(imagesTemplate, path, frameRate, codec=codec)
+        # The frames are rendered right away, as more pages may be added
+        # to the document, but the encoding can be done in the background
+        tempDir = tempfile.TemporaryDirectory(prefix="drawbot-skia-")
+        tempDirPath = pathlib.Path(tempDir.name)
+        imagePath = tempDirPath / "frame.png"
+        _savePixelImages(
+            self._pictures,
+            imagePath,
+            skia.kPNG,
+            whiteBackground=True,
+            singlePage=False,
+        )
+        imagesTemplate = tempDirPath / "frame_%d.png"
+
+        def encode():
+            with tempDir:
+                generateMP4(imagesTemplate, path, frameRate, codec=codec)
+
+        if background:
+            return _getBackgroundExecutor().submit(encode)
+        encode()
+
+
+_backgroundExecutor = None
+
+
+def _getBackgroundExecutor():
+    # A single worker, so background saves are done in order
+    global _backgroundExecutor
+    if _backgroundExecutor is None:
+        _backgroundExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="drawbot-skia")
+    return _backgroundExecutor
 
 
 def _savePixelImages(pictures, path, format, whiteBackground=False, singlePage=None):
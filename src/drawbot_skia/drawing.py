@@ -1,16 +1,28 @@
+import collections
 import contextlib
 import functools
 import math
+import os
 from typing import Tuple
+import numpy as np
 import skia
 from dataclasses import dataclass
 from .document import RecordingDocument
 from .errors import DrawbotError
-from .gstate import GraphicsState, GraphicsStateMixin
-from .path import FLIP_MATRIX
+from .gstate import GraphicsState, GraphicsStateMixin, cached_property
+from .path import BezierPath
 
 DEFAULT_CANVAS_DIMENSIONS = (1000, 1000)
 
+_DEG2RAD = math.pi / 180
+
+MAX_BATCH_PICTURES = 1024
+
+# Recorded pictures are replayed at the current transformation, so
+# their bounds need to be unrestricted
+_PICTURE_BOUNDS = skia.Rect.MakeLTRB(-1e9, -1e9, 1e9, 1e9)
+
+
 @dataclass
 class GlyphInfo:
     gid:int = 0
@@ -20,19 +32,101 @@ class GlyphInfo:
     path:skia.Path = None
 
 
+class GlyphRun:
+
+    # The result of glyphs(). Iterating, indexing, len(), comparing and
+    # concatenating work on the equivalent list of GlyphInfo objects,
+    # which is built straight from the shaped lists. The gids, positions
+    # (N, 2) and advances (N, 2) are also available as arrays, which are
+    # only built when asked for.
+
+    def __init__(self, gids, glyphOrder, positions, advances, paths=None):
+        self._gids = gids
+        self._glyphOrder = glyphOrder
+        self._positions = positions
+        self._advances = advances
+        self.paths = paths
+        self._infos = None
+
+    @cached_property
+    def gids(self):
+        return np.asarray(self._gids)
+
+    @cached_property
+    def names(self):
+        glyphOrder = self._glyphOrder
+        return [glyphOrder[gid] for gid in self._gids]
+
+    @cached_property
+    def positions(self):
+        return np.asarray(self._positions, dtype=float)
+
+    @cached_property
+    def advances(self):
+        return np.asarray(self._advances, dtype=float)
+
+    def asInfos(self):
+        if self._infos is None:
+            gids = self._gids
+            glyphOrder = self._glyphOrder
+            if self.paths is not None:
+                paths = list(map(self.paths.__getitem__, gids))
+            else:
+                paths = [None] * len(gids)
+            self._infos = [
+                GlyphInfo(
+                    gid=gid,
+                    name=glyphOrder[gid],
+                    pos=pos,
+                    adv=adv,
+                    path=path)
+                for gid, pos, adv, path in zip(gids, self._positions, self._advances, paths)
+            ]
+        return self._infos
+
+    def __iter__(self):
+        return iter(self.asInfos())
+
+    def __len__(self):
+        return len(self._gids)
+
+    def __getitem__(self, index):
+        return self.asInfos()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, GlyphRun):
+            other = other.asInfos()
+        return self.asInfos() == other
+
+    def __add__(self, other):
+        if isinstance(other, GlyphRun):
+            other = other.asInfos()
+        return self.asInfos() + other
+
+    def __radd__(self, other):
+        return other + self.asInfos()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.asInfos()!r})"
+
+
 class Drawing:
 
     def __init__(self, document=None, flipCanvas=True):
         self._flipCanvas = flipCanvas
+        self._pendingSaves = []
         self._reset(document)
 
     def _reset(self, document=None):
         self._stack = []
+        self._gstateFreeList = []
         self._gstate = GraphicsState()
         if document is None:
             document = RecordingDocument()
         self._document = document
         self._skia_canvas = None
+        self._pictureCache = None
+        self._imagePaint = skia.Paint()
 
     @property
     def _canvas(self):
@@ -95,7 +189,6 @@ class Drawing:
         self._drawItem(self._canvas.drawLine, x1, y1, x2, y2)
 
     def polygon(self, firstPoint, *points, close=True):
-        from .path import BezierPath
         bez = BezierPath()
         bez.polygon(firstPoint, *points, close=close)
         self.drawPath(bez)
@@ -107,27 +200,23 @@ class Drawing:
         self._canvas.clipPath(path.path, doAntiAlias=True)
 
     def textSize(self, txt):
-        # TODO: with some smartness we can shape only once, for a
-        # textSize()/text() call combination with the same text and
-        # the same text parameters.
-        glyphsInfo = self._gstate.textStyle.shape(txt)
+        textStyle = self._gstate.textStyle
+        glyphsInfo = textStyle.shapeCached(txt)
         textWidth = glyphsInfo.endPos[0]
-        return (textWidth, self._gstate.textStyle.skFont.getSpacing())
+        return (textWidth, textStyle.spacing)
 
     def text(self, txt, position, align=None):
         if not txt:
             # Hard Skia crash otherwise
             return
 
-        glyphsInfo = self._gstate.textStyle.shape(txt)
-        blob = self._gstate.textStyle.makeTextBlob(glyphsInfo, align)
+        glyphsInfo = self._gstate.textStyle.shapeCached(txt)
+        blob = self._gstate.textStyle.makeTextBlobCached(glyphsInfo, align)
 
         x, y = position
 
         with self._savedCanvasState():
-            self._canvas.translate(x, y)
-            if self._flipCanvas:
-                self._canvas.scale(1, -1)
+            self._translateAndFlip(x, y)
             self._drawItem(self._canvas.drawTextBlob, blob, 0, 0)
     
     def glyphs(self, txt, paths=True):
@@ -141,50 +230,35 @@ class Drawing:
         glyphsInfo = self._gstate.textStyle.shape(txt)
 
         if paths:
-            gids = sorted(set(glyphsInfo.gids))
-            _paths = [self._gstate.textStyle.skFont.getPath(gid)
-                for gid in gids]        
-            for path in _paths:
-                if path:
-                    path.transform(FLIP_MATRIX)
-
-            _paths = dict(zip(gids, _paths))
-        
-        positions = glyphsInfo.positions
-        advances = glyphsInfo.advances
-        infos = []
-
-        for idx, gid in enumerate(glyphsInfo.gids):
-            info = GlyphInfo(
-                gid=gid,
-                name=glyphOrder[gid],
-                pos=positions[idx],
-                adv=advances[idx])
-
-            if paths:
-                info.path = _paths[gid]
-            infos.append(info)
+            textStyle = self._gstate.textStyle
+            _paths = {gid: textStyle.glyphPathCached(gid)
+                for gid in dict.fromkeys(glyphsInfo.gids)}
         
-        return infos
+        return GlyphRun(
+            gids=glyphsInfo.gids,
+            glyphOrder=glyphOrder,
+            positions=glyphsInfo.positions,
+            advances=glyphsInfo.advances,
+            paths=_paths if paths else None,
+        )
 
     def image(self, imagePath, position, alpha=1.0):
         im = self._getImage(imagePath)
-        paint = skia.Paint()
+        # The canvas copies the paint, so we can reuse it
+        paint = self._imagePaint
+        paint.reset()
         if alpha != 1.0:
             paint.setAlpha(round(alpha * 255))
         if self._gstate.fillPaint.blendMode != "normal":
             paint.setBlendMode(self._gstate.fillPaint.skPaint.getBlendMode())
         x, y = position
         with self._savedCanvasState():
-            self._canvas.translate(x, y + im.height())
-            if self._flipCanvas:
-                self._canvas.scale(1, -1)
+            self._translateAndFlip(x, y + im.height())
             self._canvas.drawImage(im, 0, 0, paint)
 
     @staticmethod
-    @functools.lru_cache(maxsize=32)
     def _getImage(imagePath):
-        return skia.Image.open(imagePath)
+        return _imageCache.getImage(imagePath)
 
     def translate(self, x, y):
         self._canvas.translate(x, y)
@@ -198,76 +272,238 @@ class Drawing:
             sy = sx
         cx, cy = center
         if cx != 0 or cy != 0:
-            self._canvas.translate(cx, cy)
+            # Equivalent to translate(cx, cy), scale(sx, sy), translate(-cx, -cy)
+            self._canvas.translate(cx - sx * cx, cy - sy * cy)
             self._canvas.scale(sx, sy)
-            self._canvas.translate(-cx, -cy)
         else:
             self._canvas.scale(sx, sy)
 
     def skew(self, sx, sy=0, center=(0, 0)):
         cx, cy = center
         if cx != 0 or cy != 0:
-            self._canvas.translate(cx, cy)
-            self._canvas.skew(math.radians(sx), math.radians(sy))
-            self._canvas.translate(-cx, -cy)
+            self._canvas.concat(skia.Matrix().setSkew(sx * _DEG2RAD, sy * _DEG2RAD, cx, cy))
         else:
-            self._canvas.skew(math.radians(sx), math.radians(sy))
+            self._canvas.skew(sx * _DEG2RAD, sy * _DEG2RAD)
 
     def transform(self, matrix, center=(0, 0)):
         m = skia.Matrix()
         m.setAffine(matrix)
         cx, cy = center
         if cx != 0 or cy != 0:
-            self._canvas.translate(cx, cy)
-            self._canvas.concat(m)
-            self._canvas.translate(-cx, -cy)
-        else:
-            self._canvas.concat(m)
+            m.preTranslate(-cx, -cy)
+            m.postTranslate(cx, cy)
+        self._canvas.concat(m)
 
     @contextlib.contextmanager
     def savedState(self):
-        self._stack.append(self._gstate.copy())
+        if self._gstateFreeList:
+            savedGState = self._gstateFreeList.pop()
+        else:
+            savedGState = GraphicsState(_doInitialize=False)
+        savedGState.copyFrom(self._gstate)
+        self._stack.append(savedGState)
         self._canvas.save()
         yield
         self._canvas.restore()
+        # Nothing else refers to the discarded state, so we can reuse it
+        self._gstateFreeList.append(self._gstate)
         self._gstate = self._stack.pop()
 
-    @contextlib.contextmanager
     def _savedCanvasState(self):
-        self._canvas.save()
-        yield
-        self._canvas.restore()
+        return _SavedCanvasState(self._canvas)
+
+    def beginBatch(self):
+        # Between beginBatch() and endBatch(), shapes given by plain
+        # coordinates (rect, oval, line) that are drawn more than once with
+        # the same fill and stroke are recorded as a skia.Picture, and
+        # replayed with a single call. This only helps when the same shape
+        # and paint recur; other drawing gets slightly slower. At most
+        # MAX_BATCH_PICTURES shapes are remembered, least recently used
+        # ones are dropped, and batching stops when fewer than one in ten
+        # shapes turn out to be repeats.
+        self._pictureCache = collections.OrderedDict()
+        self._batchLookups = 0
+        self._batchHits = 0
+
+    def endBatch(self):
+        self._pictureCache = None
 
     def saveImage(self, fileName, **kwargs):
+        if not kwargs.get("background", False):
+            # A background save may still be writing to the same file
+            self.waitForSaves()
         if self._document.isDrawing:
             self._document.endPage()
-        self._document.saveImage(fileName, **kwargs)
+        future = self._document.saveImage(fileName, **kwargs)
+        if future is not None:
+            # The document saves in the background, for example an mp4
+            # with background=True. Forget about finished saves, unless
+            # they failed: waitForSaves() should raise their exception.
+            self._pendingSaves = [
+                f for f in self._pendingSaves if not f.done() or f.exception() is not None
+            ]
+            self._pendingSaves.append(future)
+        return future
+
+    def waitForSaves(self):
+        pendingSaves, self._pendingSaves = self._pendingSaves, []
+        for future in pendingSaves:
+            future.result()  # raises the exception, if saving failed
 
     # Helpers
 
+    def _translateAndFlip(self, x, y):
+        # Equivalent to translate(x, y) followed by scale(1, -1) if the
+        # canvas is flipped, but with a single canvas call
+        if self._flipCanvas:
+            self._canvas.concat(skia.Matrix.MakeAll(1, 0, x, 0, -1, y, 0, 0, 1))
+        else:
+            self._canvas.translate(x, y)
+
     def _drawItem(self, canvasMethod, *items):
-        shadowPaintFill, offset = self._gstate.fillPaint.skPaintShadowAndOffset
+        if self._pictureCache is not None and all(isinstance(item, (tuple, int, float)) for item in items):
+            picture = self._getItemPicture(canvasMethod.__name__, items)
+            if picture is not None:
+                self._canvas.drawPicture(picture)
+                return
+        self._drawItemOnCanvas(self._canvas, canvasMethod, items)
+
+    def _getItemPicture(self, canvasMethodName, items):
+        # Returns None if the item should be drawn directly
+        key = (canvasMethodName, items, self._gstate.fillPaint, self._gstate.strokePaint)
+        pictureCache = self._pictureCache
+        try:
+            seen = key in pictureCache
+        except TypeError:
+            # A paint has an unhashable property
+            return None
+        self._batchLookups += 1
+        if seen:
+            self._batchHits += 1
+        elif self._batchLookups >= MAX_BATCH_PICTURES and self._batchHits < self._batchLookups // 10:
+            # Hits are rare, so batching costs more than it gains: stop
+            # batching for the rest of this batch
+            self._pictureCache = None
+            return None
+        if not seen:
+            # Only record a picture once the item is drawn a second time,
+            # so non-repeating items don't pay for the recording
+            picture = None
+        else:
+            picture = pictureCache[key]
+            if picture is None:
+                recorder = skia.PictureRecorder()
+                canvas = recorder.beginRecording(_PICTURE_BOUNDS)
+                self._drawItemOnCanvas(canvas, getattr(canvas, canvasMethodName), items)
+                picture = recorder.finishRecordingAsPicture()
+        pictureCache[key] = picture
+        pictureCache.move_to_end(key)
+        if len(pictureCache) > MAX_BATCH_PICTURES:
+            pictureCache.popitem(last=False)
+        return picture
+
+    def _drawItemOnCanvas(self, canvas, canvasMethod, items):
+        gstate = self._gstate
+        fillPaint = gstate.fillPaint
+        strokePaint = gstate.strokePaint
+        drawFill = fillPaint.somethingToDraw
+        drawStroke = strokePaint.somethingToDraw
+
+        shadowPaintFill, offset = fillPaint.skPaintShadowAndOffset
         if shadowPaintFill is not None:
-            shadowPaintStroke, _ = self._gstate.strokePaint.skPaintShadowAndOffset
+            shadowPaintStroke, _ = strokePaint.skPaintShadowAndOffset
             dx, dy = offset
-            with self._savedCanvasState():
-                self._canvas.translate(dx, dy)
-                if self._gstate.fillPaint.somethingToDraw:
+            with _SavedCanvasState(canvas):
+                canvas.translate(dx, dy)
+                if drawFill:
                     canvasMethod(*items, shadowPaintFill)
-                if self._gstate.strokePaint.somethingToDraw:
+                if drawStroke:
                     canvasMethod(*items, shadowPaintStroke)
 
-        if self._gstate.fillPaint.somethingToDraw:
-            canvasMethod(*items, self._gstate.fillPaint.skPaint)
-        if self._gstate.strokePaint.somethingToDraw:
-            canvasMethod(*items, self._gstate.strokePaint.skPaint)
+        if drawFill:
+            canvasMethod(*items, fillPaint.skPaint)
+        if drawStroke:
+            canvasMethod(*items, strokePaint.skPaint)
+
+
+class _SavedCanvasState:
+
+    # A context manager that saves and restores the canvas state. This is
+    # used for every text, image and shadow, so it avoids the overhead of
+    # a generator-based contextlib.contextmanager.
+
+    __slots__ = ("canvas",)
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+
+    def __enter__(self):
+        self.canvas.save()
+
+    def __exit__(self, *excInfo):
+        self.canvas.restore()
+
+
+class _ImageCache:
+
+    # An LRU cache for decoded images, bounded by an estimate of the
+    # memory the decoded pixels take. Images are keyed by absolute path,
+    # and reloaded when the file's modification time changes.
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.bytesUsed = 0
+        self._images = collections.OrderedDict()  # path: (mtime, image)
+
+    def getImage(self, imagePath):
+        imagePath = os.path.abspath(imagePath)
+        mtime = os.path.getmtime(imagePath)
+        cached = self._images.get(imagePath)
+        if cached is not None:
+            cachedMTime, im = cached
+            if cachedMTime == mtime:
+                self._images.move_to_end(imagePath)
+                return im
+            # The file changed: drop the outdated image
+            del self._images[imagePath]
+            self.bytesUsed -= _imageByteSize(im)
+        im = skia.Image.open(imagePath)
+        self._images[imagePath] = (mtime, im)
+        self.bytesUsed += _imageByteSize(im)
+        # Always keep the most recent image, even if it exceeds the budget
+        while self.bytesUsed > self.maxBytes and len(self._images) > 1:
+            _, (_, oldImage) = self._images.popitem(last=False)
+            self.bytesUsed -= _imageByteSize(oldImage)
+        return im
+
+    def clear(self):
+        self._images.clear()
+        self.bytesUsed = 0
+
+
+def _imageByteSize(im):
+    return im.width() * im.height() * 4
+
+
+DEFAULT_IMAGE_CACHE_SIZE = 128 * 1024 * 1024
+
+_imageCache = _ImageCache(
+    int(os.getenv("DRAWBOT_SKIA_IMAGE_CACHE_SIZE", DEFAULT_IMAGE_CACHE_SIZE))
+)
 
 
 def _makeWrapper(name):
-    @functools.wraps(getattr(GraphicsStateMixin, name))
-    def wrapper(self, *args, **kwargs):
-        method = getattr(self._gstate, name)
-        return method(*args, **kwargs)
+    # The wrapper is generated from source, so that the delegate method
+    # is looked up with a plain attribute access instead of a getattr()
+    # call with a closure variable. It must look up self._gstate on each
+    # call, as the graphics state object does not have a fixed identity.
+    source = (
+        f"def {name}(self, *args, **kwargs):\n"
+        f"    return self._gstate.{name}(*args, **kwargs)\n"
+    )
+    namespace = {}
+    exec(source, namespace)
+    wrapper = functools.wraps(getattr(GraphicsStateMixin, name))(namespace[name])
     wrapper.__qualname__ = f"Drawing.{name}"
     return wrapper
 
@@ -1,3 +1,4 @@
+import functools
 import logging
 import os
 import skia
@@ -216,12 +217,15 @@ class GraphicsState(GraphicsStateMixin):
 
     def copy(self):
         result = GraphicsState(_doInitialize=False)
+        result.copyFrom(self)
+        return result
+
+    def copyFrom(self, other):
         # Our main attributes are copy-on-write, so we can share them with
         # our copy
-        result.fillPaint = self.fillPaint
-        result.strokePaint = self.strokePaint
-        result.textStyle = self.textStyle
-        return result
+        self.fillPaint = other.fillPaint
+        self.strokePaint = other.strokePaint
+        self.textStyle = other.textStyle
 
 
 class _ImmutableContainer:
@@ -242,6 +246,14 @@ class _ImmutableContainer:
             return False
         return all(getattr(self, n) == getattr(other, n) for n in self._names)
 
+    def __hash__(self):
+        return self._hashValue
+
+    @cached_property
+    def _hashValue(self):
+        # We're immutable, so the hash can be computed once
+        return hash(tuple((n, self.__dict__[n]) for n in sorted(self._names)))
+
     def __repr__(self):
         args = ", ".join(f"{n}={self.__dict__[n]!r}" for n in sorted(self._names))
         return f"{self.__class__.__name__}({args})"
@@ -379,9 +391,29 @@ class TextStyle(_ImmutableContainer):
     font = None
     lineHeight = None
 
+    # One-shot memos for the textSize()/text() idiom: (txt, glyphsInfo)
+    # and (glyphsInfo, align, textBlob)
+    _lastShape = None
+    _lastTextBlob = None
+
     def __init__(self, **properties):
         super().__init__(**properties)
 
+    def __hash__(self):
+        # Equal text styles (see _ImmutableContainer.__eq__) have equal
+        # style keys, so this is consistent with __eq__
+        return hash(self._styleKey)
+
+    @cached_property
+    def _styleKey(self):
+        return (
+            self.font,
+            self.fontSize,
+            tuple(sorted(self.features.items())),
+            tuple(sorted(self.variations.items())),
+            self.language,
+        )
+
     @cached_property
     def skFont(self):
         typeface, ttFont = self._getTypefaceAndTTFont(self.font)
@@ -390,6 +422,11 @@ class TextStyle(_ImmutableContainer):
         font = self._makeFontFromTypeface(typeface, self.fontSize)
         return font
 
+    @cached_property
+    def spacing(self):
+        # The recommended line spacing of the font, at our font size
+        return self.skFont.getSpacing()
+
     @property
     def ttFont(self):
         _, ttFont = self._getTypefaceAndTTFont(self.font)
@@ -462,12 +499,31 @@ class TextStyle(_ImmutableContainer):
                 glyphsInfo.gids += runInfo.gids
                 glyphsInfo.clusters += runInfo.clusters
                 glyphsInfo.positions += runInfo.positions
+                glyphsInfo.advances += runInfo.advances
                 glyphsInfo.endPos = runInfo.endPos
             startPos = runInfo.endPos
         glyphsInfo.baseLevel = baseLevel
         return glyphsInfo
 
+    def shapeCached(self, txt):
+        # The result is shared between callers, and must not be mutated
+        lastShape = self._lastShape
+        if lastShape is not None and (lastShape[0] is txt or lastShape[0] == txt):
+            return lastShape[1]
+        glyphsInfo = _shapeCached(self, txt)
+        self._lastShape = (txt, glyphsInfo)
+        return glyphsInfo
+
+    def glyphPathCached(self, gid):
+        # Return a copy, so the caller can't modify the cached path
+        path = _flippedGlyphPathCached(self, gid)
+        return skia.Path(path) if path is not None else None
+
     def alignGlyphPositions(self, glyphsInfo, align):
+        glyphsInfo.positions = self._alignedGlyphPositions(glyphsInfo, align)
+
+    @staticmethod
+    def _alignedGlyphPositions(glyphsInfo, align):
         textWidth = glyphsInfo.endPos[0]
         if align is None:
             align = "left" if not glyphsInfo.baseLevel else "right"
@@ -476,14 +532,22 @@ class TextStyle(_ImmutableContainer):
             xOffset = -textWidth
         elif align == "center":
             xOffset = -textWidth / 2
-        glyphsInfo.positions = [(x + xOffset, y) for x, y in glyphsInfo.positions]
+        return [(x + xOffset, y) for x, y in glyphsInfo.positions]
 
     def makeTextBlob(self, glyphsInfo, align):
-        self.alignGlyphPositions(glyphsInfo, align)
+        positions = self._alignedGlyphPositions(glyphsInfo, align)
         builder = skia.TextBlobBuilder()
-        builder.allocRunPos(self.skFont, glyphsInfo.gids, glyphsInfo.positions)
+        builder.allocRunPos(self.skFont, glyphsInfo.gids, positions)
         return builder.make()
 
+    def makeTextBlobCached(self, glyphsInfo, align):
+        lastTextBlob = self._lastTextBlob
+        if lastTextBlob is not None and lastTextBlob[0] is glyphsInfo and lastTextBlob[1] == align:
+            return lastTextBlob[2]
+        blob = self.makeTextBlob(glyphsInfo, align)
+        self._lastTextBlob = (glyphsInfo, align, blob)
+        return blob
+
     def getLineHeight(self):
         if self.lineHeight is not None:
             return self.lineHeight
@@ -499,6 +563,29 @@ _fontCache = {}
 
 def clearFontCache():
     _fontCache.clear()
+    _shapeCached.cache_clear()
+    _flippedGlyphPathCached.cache_clear()
+
+
+# Shaping cache: a common idiom is to call textSize() and text() with the
+# same text and text style, and scripts often draw the same text repeatedly.
+@functools.lru_cache(maxsize=512)
+def _shapeCached(textStyle, txt):
+    return textStyle.shape(txt)
+
+
+# Glyph path cache: text styles with equal font, size and variations
+# are equal, so they share cached glyph paths.
+@functools.lru_cache(maxsize=8192)
+def _flippedGlyphPathCached(textStyle, gid):
+    path = textStyle.skFont.getPath(gid)
+    if path:
+        path.transform(FLIP_MATRIX)
+    return path
+
+
+FLIP_MATRIX = skia.Matrix()
+FLIP_MATRIX.setAffine((1, 0, 0, -1, 0, 0))
 
 
 def _colorTupleToInt(color):
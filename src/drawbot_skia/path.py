@@ -4,7 +4,7 @@ import skia
 from fontTools.misc.transform import Transform
 from fontTools.pens.basePen import BasePen
 from fontTools.pens.pointPen import PointToSegmentPen, SegmentToPointPen
-from .gstate import TextStyle
+from .gstate import FLIP_MATRIX, TextStyle
 
 
 # TODO:
@@ -194,7 +194,7 @@ class BezierPath(BasePen):
         textStyle = TextStyle(font=font, fontSize=fontSize)
         glyphsInfo = textStyle.shape(txt)
         textStyle.alignGlyphPositions(glyphsInfo, align)
-        gids = sorted(set(glyphsInfo.gids))
+        gids = list(dict.fromkeys(glyphsInfo.gids))
         paths = [textStyle.skFont.getPath(gid) for gid in gids]
         for path in paths:
             path.transform(FLIP_MATRIX)
@@ -278,10 +278,6 @@ class BezierPath(BasePen):
         return self
 
 
-FLIP_MATRIX = skia.Matrix()
-FLIP_MATRIX.setAffine((1, 0, 0, -1, 0, 0))
-
-
 def _convertConicToCubicDirty(pt1, pt2, pt3):
     #
     # NOTE: we do a crude conversion from a conic segment to a cubic bezier,
@@ -1,3 +1,4 @@
+import filecmp
 import os
 import pathlib
 import sys
@@ -127,12 +128,184 @@ def test_saveImage_mp4_codec(tmpdir):
     assert expectedFilenames == [p.name for p in paths]
 
 
+def test_saveImage_mp4_background(tmpdir):
+    from drawbot_skia import ffmpeg
+    ffmpeg.FFMPEG_PATH = ffmpeg.getPyFFmpegPath()  # Force ffmpeg from pyffmpeg
+    tmpdir = pathlib.Path(tmpdir)
+    db = Drawing()
+    namespace = makeDrawbotNamespace(db)
+    runScriptSource(multipageSource, "<string>", namespace)
+    future = db.saveImage(tmpdir / "test.mp4", background=True)
+    db.newPage(200, 200)  # Adding pages doesn't affect the pending save
+    db.saveImage(tmpdir / "test2.mp4", background=True)
+    db.waitForSaves()
+    assert future.done()
+    paths = sorted(tmpdir.glob("*.mp4"))
+    assert ['test.mp4', 'test2.mp4'] == [p.name for p in paths]
+    assert paths[0].stat().st_size < paths[1].stat().st_size
+
+
+def test_saveImage_mp4_background_pending(tmpdir, monkeypatch):
+    from drawbot_skia import ffmpeg
+    tmpdir = pathlib.Path(tmpdir)
+    encoded = []
+
+    def generateMP4(imageTemplate, mp4path, frameRate, codec):
+        if "fail" in os.fspath(mp4path):
+            raise RuntimeError("encoding failed")
+        encoded.append(pathlib.Path(mp4path).name)
+
+    monkeypatch.setattr(ffmpeg, "generateMP4", generateMP4)
+    db = Drawing()
+    namespace = makeDrawbotNamespace(db)
+    runScriptSource(multipageSource, "<string>", namespace)
+    db.saveImage(tmpdir / "test1.mp4", background=True)
+    db.saveImage(tmpdir / "test2.mp4", background=True)
+    assert len(db._pendingSaves) <= 2
+    # A synchronous save waits for the pending background saves
+    db.saveImage(tmpdir / "test3.mp4")
+    assert encoded == ["test1.mp4", "test2.mp4", "test3.mp4"]
+    assert db._pendingSaves == []
+    db.saveImage(tmpdir / "fail.mp4", background=True)
+    db.saveImage(tmpdir / "test4.mp4", background=True)
+    assert len(db._pendingSaves) >= 1  # the failed save is kept
+    with pytest.raises(RuntimeError):
+        db.waitForSaves()
+
+
 def test_noFont(tmpdir):
     db = Drawing()
     # Ensure we don't get an error when font is not set
     db.text("Hallo", (0, 0))
 
 
+def test_textSize_text_shapeCached():
+    db = Drawing()
+    db.fontSize(40)
+    glyphsInfo = db._gstate.textStyle.shapeCached("Hallo")
+    positions = list(glyphsInfo.positions)
+    db.textSize("Hallo")
+    db.text("Hallo", (100, 100), align="center")
+    db.fontSize(40)  # a new, but equal, text style
+    assert glyphsInfo is db._gstate.textStyle.shapeCached("Hallo")
+    assert positions == glyphsInfo.positions
+    width, spacing = db.textSize("Hallo")
+    assert spacing == db._gstate.textStyle.skFont.getSpacing()
+    db.fontSize(50)
+    assert glyphsInfo is not db._gstate.textStyle.shapeCached("Hallo")
+    textStyle = db._gstate.textStyle
+    blob = textStyle.makeTextBlobCached(glyphsInfo, "center")
+    assert blob is textStyle.makeTextBlobCached(glyphsInfo, "center")
+    assert blob is not textStyle.makeTextBlobCached(glyphsInfo, "right")
+
+
+def test_glyphs_paths():
+    db = Drawing()
+    db.fontSize(40)
+    infos1 = db.glyphs("Hallo")
+    infos2 = db.glyphs("Hallo")
+    assert [info.name for info in infos1] == ["H", "a", "l", "l", "o"]
+    assert infos1[2].path is infos1[3].path
+    # Cached paths are shared, but the returned paths are copies
+    assert infos1[0].path is not infos2[0].path
+    assert infos1[0].path == infos2[0].path
+    assert db.glyphs("Hallo", paths=False)[0].path is None
+    glyphRun = db.glyphs("Hallo", paths=False)
+    assert glyphRun.positions.shape == (5, 2)
+    assert glyphRun.positions[1].tolist() == list(infos1[1].pos)
+    assert glyphRun.advances[:, 0].sum() == db.textSize("Hallo")[0]
+    # GlyphRun behaves like the list of GlyphInfo objects it used to be
+    assert glyphRun == db.glyphs("Hallo", paths=False)
+    assert glyphRun != infos1
+    assert glyphRun == list(glyphRun)
+    assert len(glyphRun + db.glyphs("!", paths=False)) == 6
+    assert len([] + glyphRun) == 5
+    from drawbot_skia.gstate import clearFontCache, _flippedGlyphPathCached
+    assert _flippedGlyphPathCached.cache_info().currsize
+    clearFontCache()
+    assert not _flippedGlyphPathCached.cache_info().currsize
+    # Mixed direction text is shaped in multiple runs
+    assert len(db.glyphs("abc \u05d0\u05d1\u05d2", paths=False)) == 7
+
+
+def test_imageCache(tmpdir):
+    import shutil
+    from drawbot_skia.drawing import _ImageCache
+    tmpdir = pathlib.Path(tmpdir)
+    imagePaths = [tmpdir / f"image{i}.png" for i in range(3)]
+    for imagePath in imagePaths:
+        shutil.copy(testDir / "images" / "drawbot.png", imagePath)
+    cache = _ImageCache(0)
+    im = cache.getImage(imagePaths[0])
+    assert im is cache.getImage(imagePaths[0])
+    cache.maxBytes = 2 * cache.bytesUsed
+    cache.getImage(imagePaths[1])
+    cache.getImage(imagePaths[0])
+    cache.getImage(imagePaths[2])  # evicts image1, the least recently used
+    assert list(cache._images) == [os.fspath(imagePaths[0]), os.fspath(imagePaths[2])]
+    bytesUsed = cache.bytesUsed
+    os.utime(imagePaths[0], (0, 0))
+    assert im is not cache.getImage(imagePaths[0])
+    # The outdated image is gone
+    assert list(cache._images) == [os.fspath(imagePaths[2]), os.fspath(imagePaths[0])]
+    assert all(cachedImage is not im for _, cachedImage in cache._images.values())
+    assert cache.bytesUsed == bytesUsed
+
+
+def test_batch(tmpdir):
+    tmpdir = pathlib.Path(tmpdir)
+    for batch in [False, True]:
+        db = Drawing()
+        db.newPage(200, 200)
+        if batch:
+            db.beginBatch()
+        db.stroke(0)
+        db.shadow((5, -5), 4, (0, 0, 0, 0.5))
+        for i in range(10):
+            db.fill(i / 10, 0.5, 0)
+            db.rect(10, 10, 50, 50)
+            db.translate(10, 10)
+            db.oval(10, 10, 50, 50)
+            db.line((0, 0), (100, 50))
+        db.polygon((0, 0), (50, 0), (0, 50))
+        for i in range(2):
+            db.rect(100, 100, 20, 20)
+        if batch:
+            # Only the repeated rect got recorded
+            assert len(db._pictureCache) == 31
+            assert sum(picture is not None for picture in db._pictureCache.values()) == 1
+            db.endBatch()
+        db.saveImage(tmpdir / f"batch_{batch}.png")
+    same, reason = compareImages(tmpdir / "batch_True.png", tmpdir / "batch_False.png")
+    assert reason == "data identical"
+
+
+def test_savedState_reuse():
+    db = Drawing()
+    db.fill(0)
+    for i in range(3):
+        with db.savedState():
+            db.fill(0.5)
+            with db.savedState():
+                db.fill(1)
+                assert (255, 255, 255, 255) == db._gstate.fillPaint.color
+            assert (255, 128, 128, 128) == db._gstate.fillPaint.color
+        assert (255, 0, 0, 0) == db._gstate.fillPaint.color
+    assert len(db._gstateFreeList) == 2
+
+
+def test_batch_noRepeats():
+    from drawbot_skia.drawing import MAX_BATCH_PICTURES
+    db = Drawing()
+    db.beginBatch()
+    for i in range(MAX_BATCH_PICTURES - 1):
+        db.rect(i, 0, 10, 10)
+    assert len(db._pictureCache) == MAX_BATCH_PICTURES - 1
+    db.rect(-1, 0, 10, 10)
+    # Batching stopped, as there were no repeated shapes
+    assert db._pictureCache is None
+
+
 def test_newPage_newGState():
     # Test a bug with the delegate properties of Drawing: they should
     # not return the delegate method itself, but a wrapper that calls the
@@ -201,27 +374,29 @@ def readbytes(path):
 
 
 def compareImages(path1, path2):
-    data1 = readbytes(path1)
-    data2 = readbytes(path2)
     _, ext = os.path.splitext(path1)
     if ext == ".svg":
         # Ignore line endings for svg
-        data1 = data1.splitlines()
-        data2 = data2.splitlines()
-    if data1 == data2:
-        return True, "data identical"
+        if readbytes(path1).splitlines() == readbytes(path2).splitlines():
+            return True, "data identical"
+    elif os.path.getsize(path1) == os.path.getsize(path2):
+        # The output file may have been rewritten since a previous
+        # comparison, so don't let filecmp use its stat-based cache
+        filecmp.clear_cache()
+        if filecmp.cmp(path1, path2, shallow=False):
+            return True, "data identical"
     if ext not in {".png", ".jpg"}:
         return False, "image data differs"
-    im1 = Image.open(path1)
-    im2 = Image.open(path2)
-    if im1 == im2:
-        return True, "images identical"
-    if im1.size != im2.size:
+    a1 = np.asarray(Image.open(path1))
+    a2 = np.asarray(Image.open(path2))
+    if a1.shape[:2] != a2.shape[:2]:
         return False, "sizes differ"
-    a1 = np.array(im1).astype(int)
-    a2 = np.array(im2).astype(int)
-    diff = a1 - a2
-    maxDiff = max(abs(np.max(diff)), abs(np.min(diff)))
+    if np.array_equal(a1, a2):
+        return True, "images identical"
+    # int16 is wide enough for the difference of two uint8 arrays
+    diff = a1.astype(np.int16)
+    diff -= a2
+    maxDiff = int(np.abs(diff, out=diff).max())
     if maxDiff < 128:
         return True, "images similar enough"
     return False, f"images differ too much, maxDiff: {maxDiff}"